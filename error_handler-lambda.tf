@@ -8,7 +8,8 @@ resource "aws_lambda_function" "aws_lambda_error_handler" {
   source_code_hash = filebase64sha256("error_handler.zip")
   environment {
     variables = {
-      TOPIC = "${var.prefix}-batch-job-failure"
+      TOPIC      = data.aws_sns_topic.batch_job_failure.arn
+      LOCK_TABLE = aws_dynamodb_table.aws_dynamodb_idl_locks.name
     }
   }
   timeout = 15
@@ -47,7 +48,7 @@ resource "aws_iam_role_policy_attachment" "aws_lambda_execution_role_policy_atta
 
 resource "aws_iam_policy" "aws_lambda_execution_policy" {
   name        = "${var.prefix}-lambda-error-handler-execution-policy"
-  description = "Write to CloudWatch logs, publish and list SNS Topics."
+  description = "Write to CloudWatch logs and publish to SNS Topic."
   policy = jsonencode({
     "Version" : "2012-10-17",
     "Statement" : [
@@ -69,29 +70,49 @@ resource "aws_iam_policy" "aws_lambda_execution_policy" {
         ],
         "Resource" : "${data.aws_sns_topic.batch_job_failure.arn}"
       },
-      {
-        "Sid" : "AllowListTopics",
-        "Effect" : "Allow",
-        "Action" : [
-          "sns:ListTopics"
-        ],
-        "Resource" : "*"
-      },
       {
         "Sid" : "AllowSSMGetPut",
         "Effect" : "Allow",
         "Action" : [
           "ssm:GetParameter",
+          "ssm:GetParameters",
           "ssm:PutParameter",
           "ssm:DeleteParameter",
           "ssm:DeleteParameters"
         ],
         "Resource" : "arn:aws:ssm:${var.aws_region}:${local.account_id}:parameter/${var.prefix}*"
+      },
+      {
+        "Sid" : "AllowDynamoDBLock",
+        "Effect" : "Allow",
+        "Action" : [
+          "dynamodb:PutItem",
+          "dynamodb:DeleteItem"
+        ],
+        "Resource" : "${aws_dynamodb_table.aws_dynamodb_idl_locks.arn}"
       }
     ]
   })
 }
 
+# DynamoDB table to lock IDL licenses while they are returned
+resource "aws_dynamodb_table" "aws_dynamodb_idl_locks" {
+  name         = "${var.prefix}-idl-locks"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+  attribute {
+    name = "pk"
+    type = "S"
+  }
+  ttl {
+    attribute_name = "ttl"
+    enabled        = true
+  }
+  server_side_encryption {
+    enabled = true
+  }
+}
+
 # AWS EventBridge rule triggered by Batch job failure
 resource "aws_cloudwatch_event_rule" "aws_eventbridge_batch_job_failure" {
   name        = "${var.prefix}-error-handler"
@@ -5,66 +5,231 @@ Pusblishes error message to SNS Topic.
 """
 
 # Standard imports
+import collections
+import json
 import logging
+import math
 import os
 import random
-import sys
 import time
 
 # Third-party imports
-import boto3
 import botocore
+from botocore.config import Config
+
+# AWS clients created on first use and reused across warm invocations
+CFG = Config(tcp_keepalive=True, max_pool_connections=4, retries={"max_attempts": 5, "mode": "adaptive"})
+_DYNAMODB = None
+_SNS = None
+_SSM = None
+
+# Dataset names for job queue suffixes (all others are VIIRS)
+DATASETS = { "aqua": "MODIS Aqua", "terra": "MODIS Terra" }
+
+# Backoff in seconds while waiting on another process's license hold
+HOLD_BASE_DELAY = 0.05
+HOLD_MAX_DELAY = 1.0
+HOLD_JITTER = 0.05
+
+# Seconds of the Lambda timeout kept for returning licenses after waiting
+HOLD_TIME_MARGIN = 5.0
+
+# Backoff in seconds when placing or removing a license hold conflicts
+HOLD_PUT_BASE_DELAY = 0.5
+HOLD_PUT_ATTEMPTS = 4
+
+# DynamoDB table used to lock licenses (SSM hold only when not set)
+LOCK_TABLE = os.environ.get("LOCK_TABLE")
+
+# Seconds a lock outlives the invocation that holds it
+LOCK_TTL_MARGIN = 2
+
+# Maximum number of messages in an SNS PublishBatch request
+SNS_BATCH_SIZE = 10
+
+# SNS Topic name or ARN to publish to
+TOPIC_NEEDLE = os.environ["TOPIC"]
+
+# SNS Topic ARN resolved on first publish
+_TOPIC_ARN = None
+
+# Logger created on first invocation
+_LOGGER = None
+
+class LicenseHoldError(Exception):
+    """Raised when another process does not release its license hold."""
+
+class TopicNotFoundError(Exception):
+    """Raised when no SNS Topic matches TOPIC."""
+
+class DebugBufferHandler(logging.Handler):
+    """Keep recent DEBUG records and only write them to the target handler
+    when an error is logged."""
+    
+    def __init__(self, target, capacity=64):
+        super().__init__(logging.DEBUG)
+        self.target = target
+        self.buffer = collections.deque(maxlen=capacity)
+        
+    def emit(self, record):
+        if record.levelno == logging.DEBUG:
+            self.buffer.append(record)
+        elif record.levelno >= logging.ERROR:
+            while self.buffer:
+                self.target.handle(self.buffer.popleft())
+                
+    def flush(self):
+        """Discard buffered records as no error was logged."""
+        
+        self.buffer.clear()
+
+def get_dynamodb():
+    """Return DynamoDB client, importing boto3 and creating it on first use."""
+    
+    global _DYNAMODB
+    if _DYNAMODB is None:
+        import boto3
+        _DYNAMODB = boto3.client("dynamodb", config=CFG)
+    return _DYNAMODB
+
+def get_sns():
+    """Return SNS client, importing boto3 and creating it on first use."""
+    
+    global _SNS
+    if _SNS is None:
+        import boto3
+        _SNS = boto3.client("sns", config=CFG)
+    return _SNS
+
+def get_ssm():
+    """Return SSM client, importing boto3 and creating it on first use."""
+    
+    global _SSM
+    if _SSM is None:
+        import boto3
+        _SSM = boto3.client("ssm", region_name="us-west-2", config=CFG)
+    return _SSM
 
 def error_handler(event, context):
-    """Handles error events delivered from EventBridge."""
+    """Handles error events delivered from EventBridge.
+    
+    Events may also be delivered as a batch of SQS records that each contain
+    an EventBridge event. Their messages are published together and records
+    that fail are returned as batchItemFailures so only they are retried.
+    This requires an SQS event source mapping with ReportBatchItemFailures
+    enabled, which is not deployed by this repository.
+    """
+    
+    logger = get_logger()
+    
+    # Stop waiting on license holds in time to return licenses before the Lambda times out
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - HOLD_TIME_MARGIN
+    try:
+        if "Records" in event:
+            return handle_records(event["Records"], deadline, logger)
+        
+        job, message = parse_job_event(event, logger)
+        publish_messages([message], logger)
+        return_job_licenses(job, deadline, logger)
+    except Exception as e:
+        logger.error("Could not handle job failure event: %s", e)
+        raise e
+    finally:
+        # Discard buffered debug messages
+        flush_logger(logger)
+        
+def handle_records(records, deadline, logger):
+    """Publish failed job events from SQS records together and return their
+    reserved licenses.
+    
+    Returns batchItemFailures for records that could not be parsed,
+    published or have their licenses returned.
+    """
+    
+    batch_item_failures = []
+    
+    # Log events and build messages
+    message_ids = []
+    jobs = []
+    messages = []
+    for record in records:
+        try:
+            job, message = parse_job_event(json.loads(record["body"]), logger)
+        except Exception as e:
+            logger.error("Could not handle job failure event in message %s: %s", record["messageId"], e)
+            batch_item_failures.append({ "itemIdentifier": record["messageId"] })
+            continue
+        message_ids.append(record["messageId"])
+        jobs.append(job)
+        messages.append(message)
+    
+    # Publish messages together, retrying every record if the request fails
+    try:
+        failed_indexes = publish_messages(messages, logger) if messages else set()
+    except Exception as e:
+        logger.error("Could not publish job failure events: %s", e)
+        failed_indexes = set(range(len(messages)))
+    
+    # Return licenses only for jobs that were published
+    for i, (message_id, job) in enumerate(zip(message_ids, jobs)):
+        if i in failed_indexes:
+            batch_item_failures.append({ "itemIdentifier": message_id })
+            continue
+        try:
+            return_job_licenses(job, deadline, logger)
+        except Exception as e:
+            logger.error("Could not handle job failure event in message %s: %s", message_id, e)
+            batch_item_failures.append({ "itemIdentifier": message_id })
+    return { "batchItemFailures": batch_item_failures }
+        
+def parse_job_event(event, logger):
+    """Log a failed job event.
+    
+    Returns job details needed to return licenses and the SNS subject and
+    message.
+    """
     
     # Get data
-    if len(event['detail']['attempts']) > 0:
-        error_msg = event['detail']['attempts'][0]['statusReason']
-    else:
-        error_msg = event['detail']['statusReason']
-    unique_id = get_unique_id(event['detail']['container']['command'])
-    prefix = '-'.join(event['detail']['jobName'].split('-')[0:3])
-    dataset = event['detail']['jobQueue'].split('-')[-1]
-    if len(event['detail']['attempts']) > 0: 
-        log_stream = event['detail']['attempts'][0]['container']['logStreamName']
+    detail = event['detail']
+    attempt = detail['attempts'][0] if detail['attempts'] else None
+    if attempt:
+        error_msg = attempt['statusReason']
+        log_stream = attempt['container']['logStreamName']
     else:
+        error_msg = detail['statusReason']
         log_stream = ""
+    command = detail['container']['command']
+    unique_id = get_unique_id(command)
+    prefix = '-'.join(detail['jobName'].split('-')[0:3])
+    dataset = detail['jobQueue'].split('-')[-1]
     
-    # Log and publish event
-    logger = get_logger()
-    execution_data = log_event(event, error_msg, unique_id, prefix, dataset, log_stream, logger)
-    publish_event(event, error_msg, log_stream, logger)
+    # Log event
+    execution_data = log_event(event, error_msg, unique_id, prefix, dataset, log_stream, command, logger)
+    job = (detail['jobId'], unique_id, prefix, dataset, execution_data)
+    return job, create_message(event, error_msg, log_stream, command)
     
-    # Sleep for a random amount of time for multiple job failures
-    random.seed(a=event['detail']['jobId'], version=2)
-    rand_float = random.uniform(1,10)
-    logger.info(f"Sleeping for {rand_float} seconds.")
-    time.sleep(rand_float)
+def return_job_licenses(job, deadline, logger):
+    """Return a failed job's reserved licenses and print final log message."""
+    
+    job_id, unique_id, prefix, dataset, execution_data = job
+    
+    # Seed backoff jitter so concurrent job failures retry at different times
+    random.seed(a=job_id, version=2)
     
     # Return reserved licenses
-    try:
-        idl_license_dict = return_licenses(unique_id, prefix, dataset, logger)
-    except botocore.exceptions.ClientError as e:
-        if "(ParameterNotFound)" in str(e):
-            logger.error(e)
-            logger.info("No unique licenses were tracked in the parameter store for this execution.")
-            idl_license_dict = { "floating_idl_located": "None", "floating_idl_located_number": 0, "dataset_quicklook_idl_located": "None", "dataset_quicklook_idl_located_number": 0, "dataset_refined_idl_located": "None", "dataset_refined_idl_located_number": 0 }
-        elif "(TooManyUpdates)" in str(e):
-            logger.error(e)
-            logger.info("Trying to update the parameter store at the same time as another lambda.")
-            idl_license_dict = { "floating_idl_located": "None", "floating_idl_located_number": 0, "dataset_quicklook_idl_located": "None", "dataset_quicklook_idl_located_number": 0, "dataset_refined_idl_located": "None", "dataset_refined_idl_located_number": 0 }
-        else:
-            logger.info(f"Error trying to restore reserved IDL licenses to the parameter store.")
-            logger.error(e)
-            logger.info("System exit.")
-            sys.exit(1)
-            
+    idl_license_dict = restore_licenses(job_id, unique_id, prefix, dataset, deadline, logger)
+    
     # Print final log message
     print_final_log(logger, execution_data, idl_license_dict)
     
 def get_logger():
-    """Return a formatted logger object."""
+    """Return a formatted logger object.
+    
+    The logger is created once and reused on warm invocations.
+    """
+    
+    global _LOGGER
+    if _LOGGER is not None: return _LOGGER
     
     # Remove AWS Lambda logger
     logger = logging.getLogger()
@@ -77,146 +242,243 @@ def get_logger():
 
     # Create a handler to console and set level
     console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
 
     # Create a formatter and add it to the handler
     console_format = logging.Formatter("%(module)s - %(levelname)s : %(message)s")
     console_handler.setFormatter(console_format)
+    
+    # Keep debug messages and only write them to console on error
+    debug_handler = DebugBufferHandler(console_handler)
 
-    # Add handlers to logger
+    # Add handlers to logger with debug messages written before the error that triggers them
+    logger.addHandler(debug_handler)
     logger.addHandler(console_handler)
 
     # Return logger
-    return logger
+    _LOGGER = logger
+    return _LOGGER
 
-def log_event(event, error_msg, unique_id, prefix, dataset, log_stream, logger):
+def flush_logger(logger):
+    """Flush console output and discard buffered debug messages."""
+    
+    for handler in logger.handlers:
+        handler.flush()
+
+def log_event(event, error_msg, unique_id, prefix, dataset, log_stream, command, logger):
     """Log event details in CloudWatch."""
     
-    logger.info(f"Event: {event}")
-    logger.info(f"Failed job environment: {prefix.split('-')[-1].upper()}")
-    logger.info(f"Failed job account: {event['account']}")
-    logger.info(f"Failed job queue: {event['detail']['jobQueue']}")
-    logger.info(f"Failed job name: {event['detail']['jobName']}")
-    logger.info(f"Failed job id: {event['detail']['jobId']}")
-    if log_stream: logger.info(f"Failed job log stream: {log_stream}")
-    logger.info(f"Failed job unique identifier: {unique_id}")
-    if dataset == "aqua":
-        ds = "MODIS Aqua"
-    elif dataset == "terra":
-        ds = "MODIS Terra"
-    else:
-        ds = "VIIRS"
-    logger.info(f"Failed job dataset: {ds}")
-    logger.info(f"Failed job container command: {event['detail']['container']['command']}")
-    logger.info(f"Failed job error message: '{error_msg}'")
-    
-    execution_data = f"failed_job_environment: {prefix.split('-')[-1].upper()} "\
-        + f"- failed_job_account: {event['account']} - " \
-        + f"failed_job_queue: {event['detail']['jobQueue']} - " \
-        + f"failed_job_name: {event['detail']['jobName']} - " \
-        + f"failed_job_id: {event['detail']['jobId']} - "
-    if log_stream: execution_data += f"failed_job_logstream: {log_stream} - "
-    execution_data += f"failed_job_unique_id: {unique_id} - " \
-        + f"failed_job_dataset: {ds} - " \
-        + f"failed_job_command: {event['detail']['container']['command']} - " \
-        + f"failed_job_error_message: {error_msg}"
+    detail = event['detail']
+    environment = prefix.split('-')[-1].upper()
+    ds = DATASETS.get(dataset, "VIIRS")
+    logger.debug("Event: %s", event)
+    if logger.isEnabledFor(logging.INFO):
+        record = {
+            "environment": environment,
+            "account": event['account'],
+            "queue": detail['jobQueue'],
+            "name": detail['jobName'],
+            "id": detail['jobId'],
+            "log_stream": log_stream,
+            "unique_id": unique_id,
+            "dataset": ds,
+            "command": command,
+            "error_msg": error_msg
+        }
+        logger.info(json.dumps(record, default=str))
+    
+    execution_data = "failed_job_environment: %s - failed_job_account: %s - " \
+        "failed_job_queue: %s - failed_job_name: %s - failed_job_id: %s - " \
+        "%sfailed_job_unique_id: %s - failed_job_dataset: %s - " \
+        "failed_job_command: %s - failed_job_error_message: %s" % (
+            environment, event['account'],
+            detail['jobQueue'], detail['jobName'], detail['jobId'],
+            f"failed_job_logstream: {log_stream} - " if log_stream else "", unique_id, ds,
+            command, error_msg
+        )
     return execution_data
     
-def publish_event(event, error_msg, log_stream, logger):
-    """Publish event to SNS Topic."""
+def create_message(event, error_msg, log_stream, command):
+    """Return SNS subject and message for a failed job event."""
+    
+    detail = event['detail']
+    subject = f"Generate Batch Job Failure: {detail['jobName'].split('-')[-2].upper()}"
+    parts = [
+        "A Generate AWS Batch job has FAILED. Manual intervention required.\n\n",
+        "JOB INFORMATION:\n",
+        f"Job name: {detail['jobName']}.\n",
+        f"Job identifier: {detail['jobId']}.\n",
+        f"Job queue: {detail['jobQueue']}.\n"
+    ]
+    if log_stream:
+        parts.append(f"Log file: {log_stream}\n")
+    parts.extend([
+        f"Container command: {command}\n",
+        "\nERROR INFORMATION:\n",
+        f"Error message:\n\t'{error_msg}'\n\n",
+        "\nThis indicates that a job has failed and manual intervention is required to resubmit OBPG files associated with the failure to the Generate workflow.\n\n",
+        "Please follow these steps to diagnose and recover from the failure: https://wiki.jpl.nasa.gov/pages/viewpage.action?pageId=771470900#GenerateCloudErrorDetection&Recovery-AWSBatchJobFailures\n\n\n"
+    ])
+    message = "".join(parts)
+    return subject, message
     
-    sns = boto3.client("sns")
+def publish_messages(messages, logger):
+    """Publish list of subject and message pairs to SNS Topic.
+    
+    A single message is published on its own and multiple messages are
+    published with PublishBatch in groups of up to 10. Returns the set of
+    indexes of messages that SNS did not accept in a batch.
+    """
     
     # Get topic ARN
     try:
-        topics = sns.list_topics()
+        topic_arn = resolve_topic_arn(get_sns())
     except botocore.exceptions.ClientError as e:
         logger.info("Failed to list SNS Topics.")
-        logger.error(f"Error - {e}")
-        sys.exit(1)
-    for topic in topics["Topics"]:
-        if os.environ.get("TOPIC") in topic["TopicArn"]:
-            topic_arn = topic["TopicArn"]
+        logger.error("Error - %s", e)
+        raise e
             
     # Publish to topic
-    subject = f"Generate Batch Job Failure: {event['detail']['jobName'].split('-')[-2].upper()}"
-    message = f"A Generate AWS Batch job has FAILED. Manual intervention required.\n\n" \
-        + "JOB INFORMATION:\n" \
-        + f"Job name: {event['detail']['jobName']}.\n" \
-        + f"Job identifier: {event['detail']['jobId']}.\n" \
-        + f"Job queue: {event['detail']['jobQueue']}.\n"
-    
-    if log_stream:
-        message += f"Log file: {log_stream}\n"
-        
-    message += f"Container command: {event['detail']['container']['command']}\n"
-    
-    message += "\nERROR INFORMATION:\n" \
-        + f"Error message:\n\t'{error_msg}'\n\n"
-    message += "\nThis indicates that a job has failed and manual intervention is required to resubmit OBPG files associated with the failure to the Generate workflow.\n\n"
-    message += "Please follow these steps to diagnose and recover from the failure: https://wiki.jpl.nasa.gov/pages/viewpage.action?pageId=771470900#GenerateCloudErrorDetection&Recovery-AWSBatchJobFailures\n\n\n"
+    failed_indexes = set()
     try:
-        response = sns.publish(
-            TopicArn = topic_arn,
-            Message = message,
-            Subject = subject
-        )
-        logger.info(f"Published error message to: {topic_arn}.")
+        if len(messages) == 1:
+            subject, message = messages[0]
+            response = get_sns().publish(
+                TopicArn = topic_arn,
+                Message = message,
+                Subject = subject
+            )
+        else:
+            for i in range(0, len(messages), SNS_BATCH_SIZE):
+                entries = [ { "Id": str(j), "Subject": subject, "Message": message } 
+                           for j, (subject, message) in enumerate(messages[i:i + SNS_BATCH_SIZE], start=i) ]
+                response = get_sns().publish_batch(
+                    TopicArn = topic_arn,
+                    PublishBatchRequestEntries = entries
+                )
+                for failed in response.get("Failed", []):
+                    logger.error("Error - %s: %s - %s", failed['Id'], failed['Code'], failed.get('Message', ''))
+                    failed_indexes.add(int(failed['Id']))
+        if failed_indexes:
+            logger.info("Failed to publish %s message(s) to SNS Topic: %s.", len(failed_indexes), topic_arn)
+        logger.info("Published %s error message(s) to: %s.", len(messages) - len(failed_indexes), topic_arn)
     except botocore.exceptions.ClientError as e:
-        logger.info(f"Failed to publish to SNS Topic: {topic_arn}.")
-        logger.error(f"Error - {e}")
-        sys.exit(1)
+        logger.info("Failed to publish to SNS Topic: %s.", topic_arn)
+        logger.error("Error - %s", e)
+        raise e
+    return failed_indexes
+    
+def resolve_topic_arn(sns):
+    """Return SNS Topic ARN, searching topics only when it is not cached.
+    
+    TOPIC may be a full ARN in which case no topics are listed. Otherwise the
+    last topic that contains TOPIC is used, which requires sns:ListTopics.
+    Raises TopicNotFoundError if no topic matches.
+    """
+    
+    global _TOPIC_ARN
+    if _TOPIC_ARN: return _TOPIC_ARN
+    
+    if TOPIC_NEEDLE.startswith("arn:"):
+        _TOPIC_ARN = TOPIC_NEEDLE
+        return _TOPIC_ARN
+    
+    topic_arn = None
+    paginator = sns.get_paginator("list_topics")
+    for page in paginator.paginate():
+        for topic in page["Topics"]:
+            if TOPIC_NEEDLE in topic["TopicArn"]:
+                topic_arn = topic["TopicArn"]
+    if topic_arn is None:
+        raise TopicNotFoundError(f"No SNS Topic matches: {TOPIC_NEEDLE}.")
+    _TOPIC_ARN = topic_arn
+    return _TOPIC_ARN
     
 def get_unique_id(command):
     """Parse and return unique ID from container command."""
     
     unique_id = ""
-    for arg in command:
-        if "json" in arg:
-            unique_id = arg.split('.')[0].split('_')[-1]
+    json_arg = next((arg for arg in reversed(command) if ".json" in arg), None)
+    if json_arg is not None:
+        file_name = json_arg.rpartition('/')[2]
+        unique_id = file_name.partition('.')[0].rpartition('_')[2]
         
     if unique_id == "":    # License returner
         unique_id = command[0]
         
     return unique_id
     
-def return_licenses(unique_id, prefix, dataset, logger):
+def restore_licenses(job_id, unique_id, prefix, dataset, deadline, logger):
+    """Return reserved licenses and handle parameter store errors.
+    
+    Returns dictionary of located license parameters and numbers.
+    """
+    
+    ssm = get_ssm()
+    try:
+        idl_license_dict = return_licenses(job_id, unique_id, prefix, dataset, deadline, logger)
+    except ssm.exceptions.ParameterNotFound as e:
+        logger.warning(e)
+        logger.info("No unique licenses were tracked in the parameter store for this execution.")
+        idl_license_dict = { "floating_idl_located": "None", "floating_idl_located_number": 0, "dataset_quicklook_idl_located": "None", "dataset_quicklook_idl_located_number": 0, "dataset_refined_idl_located": "None", "dataset_refined_idl_located_number": 0 }
+    except ssm.exceptions.TooManyUpdates as e:
+        logger.warning(e)
+        logger.info("Trying to update the parameter store at the same time as another lambda.")
+        idl_license_dict = { "floating_idl_located": "None", "floating_idl_located_number": 0, "dataset_quicklook_idl_located": "None", "dataset_quicklook_idl_located_number": 0, "dataset_refined_idl_located": "None", "dataset_refined_idl_located_number": 0 }
+    except botocore.exceptions.ClientError as e:
+        logger.info("Error trying to restore reserved IDL licenses to the parameter store.")
+        logger.error(e)
+        raise e
+    return idl_license_dict
+    
+def return_licenses(job_id, unique_id, prefix, dataset, deadline, logger):
     """Return licenses that were reserved for current workflow."""
     
-    ssm = boto3.client("ssm", region_name="us-west-2")
+    ssm = get_ssm()
     try:
-        # Get number of licenses that were used in the workflow
-        quicklook_lic = check_existence(ssm, f"{prefix}-idl-{dataset}-{unique_id}-ql", logger)
-        refined_lic = check_existence(ssm, f"{prefix}-idl-{dataset}-{unique_id}-r", logger)
-        floating_lic = check_existence(ssm, f"{prefix}-idl-{dataset}-{unique_id}-floating", logger)
+        # Get number of licenses that were used in the workflow and hold status
+        ql_name = f"{prefix}-idl-{dataset}-{unique_id}-ql"
+        r_name = f"{prefix}-idl-{dataset}-{unique_id}-r"
+        floating_name = f"{prefix}-idl-{dataset}-{unique_id}-floating"
+        hold_name = f"{prefix}-idl-retrieving-license"
+        parameters = get_parameters(ssm, [ql_name, r_name, floating_name, hold_name])
+        quicklook_lic = parameters[ql_name]
+        refined_lic = parameters[r_name]
+        floating_lic = parameters[floating_name]
+        for ltype, parameter_name in (("quicklook dataset", ql_name), ("refined dataset", r_name), ("floating", floating_name)):
+            if parameters[parameter_name] != 0:
+                logger.info("Located %s %s: %s reserved licenses.", ltype, parameter_name, parameters[parameter_name])
         
         # Return licenses if they are available
         if quicklook_lic != 0 or refined_lic != 0 or floating_lic != 0:
         
-            # Wait until no other process is updating license info
-            retrieving_lic =  ssm.get_parameter(Name=f"{prefix}-idl-retrieving-license")["Parameter"]["Value"]
-            while retrieving_lic == "True":
-                logger.info("Waiting for license retrieval...")
-                time.sleep(3)
-                retrieving_lic =  ssm.get_parameter(Name=f"{prefix}-idl-retrieving-license")["Parameter"]["Value"]
-            
-            # Place hold on licenses so they are not changed
-            hold_license(ssm, prefix, "True", logger)
-            
-            # Return licenses to appropriate parameters
-            write_licenses(ssm, quicklook_lic, refined_lic, floating_lic, prefix, dataset, logger)
-            
-            # Delete unique parameters
-            response = ssm.delete_parameters(
-                Names=[f"{prefix}-idl-{dataset}-{unique_id}-ql",
-                    f"{prefix}-idl-{dataset}-{unique_id}-r",
-                    f"{prefix}-idl-{dataset}-{unique_id}-floating"]
-            )
-            if quicklook_lic != 0: logger.info(f"Deleted parameter: {prefix}-idl-{dataset}-{unique_id}-ql")
-            if refined_lic != 0: logger.info(f"Deleted parameter: {prefix}-idl-{dataset}-{unique_id}-r")
-            if floating_lic != 0: logger.info(f"Deleted parameter: {prefix}-idl-{dataset}-{unique_id}-floating")
+            # Lock licenses so other error handlers wait their turn
+            if LOCK_TABLE: acquire_lock(get_dynamodb(), prefix, job_id, deadline, logger)
+            try:
+                # Wait until no other process is updating license info, re-reading the hold once locked
+                retrieving_lic = get_parameters(ssm, [hold_name])[hold_name] if LOCK_TABLE else parameters[hold_name]
+                wait_for_hold(ssm, prefix, retrieving_lic, deadline, logger)
             
-            # Release hold as done updating
-            hold_license(ssm, prefix, "False", logger)
+                # Place hold on licenses so they are not changed
+                hold_license(ssm, prefix, "True", deadline, logger)
+                try:
+                    # Return licenses to appropriate parameters
+                    write_licenses(ssm, quicklook_lic, refined_lic, floating_lic, prefix, dataset, logger)
+                
+                    # Delete unique parameters
+                    response = ssm.delete_parameters(
+                        Names=[f"{prefix}-idl-{dataset}-{unique_id}-ql",
+                            f"{prefix}-idl-{dataset}-{unique_id}-r",
+                            f"{prefix}-idl-{dataset}-{unique_id}-floating"]
+                    )
+                    if quicklook_lic != 0: logger.info("Deleted parameter: %s", ql_name)
+                    if refined_lic != 0: logger.info("Deleted parameter: %s", r_name)
+                    if floating_lic != 0: logger.info("Deleted parameter: %s", floating_name)
+                finally:
+                    # Release hold as done updating, even if returning licenses failed
+                    hold_license(ssm, prefix, "False", deadline, logger)
+            finally:
+                if LOCK_TABLE: release_lock(get_dynamodb(), prefix, job_id, logger)
             
             return { "floating_idl_located": f"{prefix}-idl-{dataset}-{unique_id}-floating", "floating_idl_located_number": floating_lic, "dataset_quicklook_idl_located": f"{prefix}-idl-{dataset}-{unique_id}-ql",  "dataset_quicklook_idl_located_number": quicklook_lic, "dataset_refined_idl_located": f"{prefix}-idl-{dataset}-{unique_id}-r", "dataset_refined_idl_located_number": refined_lic }
             
@@ -227,83 +489,167 @@ def return_licenses(unique_id, prefix, dataset, logger):
     except botocore.exceptions.ClientError as e:
         raise e
     
-def check_existence(ssm, parameter_name, logger):
-        """Check existence of SSM parameter and return value if it exists.
+def get_parameters(ssm, parameter_names):
+        """Read SSM parameters in a single request.
         
-        Returns 0 if does not exist.
+        Returns a dictionary of parameter name to value with 0 for parameters
+        that do not exist.
         """
         
-        try:
-            parameter = ssm.get_parameter(Name=parameter_name)["Parameter"]["Value"]
-            if "floating" in parameter_name:
-                ltype = "floating"
-            elif "ql" in parameter_name:
-                ltype = "quicklook dataset"
-            else:
-                ltype = "refined dataset"
-            logger.info(f"Located {ltype} {parameter_name}: {parameter} reserved licenses.")
-        except botocore.exceptions.ClientError as e:
-            if "(ParameterNotFound)" in str(e) :
-                parameter = 0
-            else:
-                raise e
-        return parameter   
+        response = ssm.get_parameters(Names=parameter_names)
+        parameters = { name: 0 for name in response.get("InvalidParameters", []) }
+        for parameter in response["Parameters"]:
+            parameters[parameter["Name"]] = parameter["Value"]
+        return parameters
 
-def hold_license(ssm, prefix, on_hold, logger):
-        """Put parameter license number ot use indicating retrieval in process."""
+def wait_for_hold(ssm, prefix, retrieving_lic, deadline, logger):
+        """Wait with jittered exponential backoff until no other process holds
+        licenses.
+        
+        Raises LicenseHoldError if the hold is not released before the
+        deadline, a time.monotonic() value.
+        """
+        
+        attempt = 0
+        while retrieving_lic == "True":
+            delay = min(HOLD_BASE_DELAY * 2 ** attempt, HOLD_MAX_DELAY) + random.uniform(0, HOLD_JITTER)
+            if time.monotonic() + delay > deadline:
+                logger.error("License hold was not released after %s attempts.", attempt)
+                raise LicenseHoldError(f"{prefix}-idl-retrieving-license was not released after {attempt} attempts.")
+            logger.info("Waiting %s seconds for license retrieval...", delay)
+            time.sleep(delay)
+            attempt += 1
+            retrieving_lic = ssm.get_parameter(Name=f"{prefix}-idl-retrieving-license")["Parameter"]["Value"]
+
+def acquire_lock(dynamodb, prefix, owner, deadline, logger):
+        """Acquire lock on licenses with a DynamoDB conditional write.
+        
+        Locks record their owner and expire LOCK_TTL_MARGIN seconds after the
+        invocation times out so a failed invocation does not hold licenses
+        after it has stopped. Raises LicenseHoldError
+        if the lock is not acquired before the deadline, a time.monotonic()
+        value.
+        """
+        
+        attempt = 0
+        while True:
+            now = int(time.time())
+            expires = now + math.ceil(deadline + HOLD_TIME_MARGIN - time.monotonic()) + LOCK_TTL_MARGIN
+            try:
+                response = dynamodb.put_item(
+                    TableName=LOCK_TABLE,
+                    Item={ "pk": { "S": prefix }, "owner": { "S": owner }, "ttl": { "N": str(expires) } },
+                    ConditionExpression="attribute_not_exists(pk) OR #ttl < :now",
+                    ExpressionAttributeNames={ "#ttl": "ttl" },
+                    ExpressionAttributeValues={ ":now": { "N": str(now) } }
+                )
+                logger.info("Acquired lock on licenses...")
+                return
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                delay = min(HOLD_BASE_DELAY * 2 ** attempt, HOLD_MAX_DELAY) + random.uniform(0, HOLD_JITTER)
+                if time.monotonic() + delay > deadline:
+                    logger.error("License lock was not acquired after %s attempts.", attempt + 1)
+                    raise LicenseHoldError(f"{prefix} lock in {LOCK_TABLE} was not acquired after {attempt + 1} attempts.")
+                logger.info("Waiting %s seconds for license lock...", delay)
+                time.sleep(delay)
+                attempt += 1
+        
+def release_lock(dynamodb, prefix, owner, logger):
+        """Release lock on licenses by deleting the DynamoDB item if it is
+        still owned by this invocation.
+        
+        Errors are logged and not raised so they do not hide an error raised
+        while the lock was held; the lock expires once the invocation times out.
+        """
         
-        hold_action = "place" if on_hold == "True" else "remove"        
         try:
-            response = ssm.put_parameter(
-                Name=f"{prefix}-idl-retrieving-license",
-                Type="String",
-                Value=on_hold,
-                Tier="Standard",
-                Overwrite=True
+            response = dynamodb.delete_item(
+                TableName=LOCK_TABLE,
+                Key={ "pk": { "S": prefix } },
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={ "#owner": "owner" },
+                ExpressionAttributeValues={ ":owner": { "S": owner } }
             )
-            logger.info(f"{hold_action.capitalize()}d a hold on licenses...")
+            logger.info("Released lock on licenses...")
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            logger.warning("Lock on licenses expired and is held by another process...")
         except botocore.exceptions.ClientError as e:
-            logger.info(f"Could not {hold_action} a hold on licenses...")
-            raise e
+            logger.warning("Could not release lock on licenses: %s", e)
+
+def hold_license(ssm, prefix, on_hold, deadline, logger):
+        """Put parameter license number ot use indicating retrieval in process.
+        
+        Conflicting updates are retried until HOLD_PUT_ATTEMPTS or until the
+        next retry would pass the deadline, a time.monotonic() value.
+        """
+        
+        hold_action = "place" if on_hold == "True" else "remove"        
+        for attempt in range(HOLD_PUT_ATTEMPTS):
+            try:
+                response = ssm.put_parameter(
+                    Name=f"{prefix}-idl-retrieving-license",
+                    Type="String",
+                    Value=on_hold,
+                    Tier="Standard",
+                    Overwrite=True
+                )
+                logger.info("%sd a hold on licenses...", hold_action.capitalize())
+                return
+            except ssm.exceptions.TooManyUpdates as e:
+                delay = random.uniform(0, HOLD_PUT_BASE_DELAY * 2 ** attempt)
+                if attempt == HOLD_PUT_ATTEMPTS - 1 or time.monotonic() + delay > deadline:
+                    logger.info("Could not %s a hold on licenses...", hold_action)
+                    raise e
+                logger.info("Too many updates to %s a hold on licenses, retrying in %s seconds...", hold_action, delay)
+                time.sleep(delay)
+            except botocore.exceptions.ClientError as e:
+                logger.info("Could not %s a hold on licenses...", hold_action)
+                raise e
         
 def write_licenses(ssm, quicklook_lic, refined_lic, floating_lic, prefix, dataset, logger):
-    """Write license data to indicate number of licenses ready to be used."""
+    """Write license data to indicate number of licenses ready to be used.
     
+    Totals that have no licenses to return are not read or written.
+    """
+    
+    dataset_lic = int(quicklook_lic) + int(refined_lic)
+    floating_lic = int(floating_lic)
+    dataset_name = f"{prefix}-idl-{dataset}"
+    floating_name = f"{prefix}-idl-floating"
     try:
-        current = ssm.get_parameter(Name=f"{prefix}-idl-{dataset}")["Parameter"]["Value"]
-        total = int(quicklook_lic) + int(refined_lic) + int(current)
-        if total > 0:
+        names = [ name for name, lic in ((dataset_name, dataset_lic), (floating_name, floating_lic)) if lic > 0 ]
+        current_licenses = get_parameters(ssm, names) if names else {}
+        
+        if dataset_lic > 0:
+            total = dataset_lic + int(current_licenses[dataset_name])
             response = ssm.put_parameter(
-                Name=f"{prefix}-idl-{dataset}",
+                Name=dataset_name,
                 Type="String",
                 Value=str(total),
                 Tier="Standard",
                 Overwrite=True
             )
-        logger.info(f"Wrote {int(quicklook_lic) + int(refined_lic)} license(s) to {prefix}-idl-{dataset}.")
+        logger.info("Wrote %s license(s) to %s.", dataset_lic, dataset_name)
         
-        current_floating = ssm.get_parameter(Name=f"{prefix}-idl-floating")["Parameter"]["Value"]
-        floating_total = int(floating_lic) + int(current_floating)
-        if floating_total > 0:
+        if floating_lic > 0:
+            floating_total = floating_lic + int(current_licenses[floating_name])
             response = ssm.put_parameter(
-                Name=f"{prefix}-idl-floating",
+                Name=floating_name,
                 Type="String",
                 Value=str(floating_total),
                 Tier="Standard",
                 Overwrite=True
             )
-        logger.info(f"Wrote {floating_lic} license(s) to {prefix}-idl-floating.")
+        logger.info("Wrote %s license(s) to %s.", floating_lic, floating_name)
     except botocore.exceptions.ClientError as e:
-        logger.info(f"Could not return {int(quicklook_lic) + int(refined_lic)} {prefix}-idl-{dataset} and {floating_lic} {prefix}-idl-floating licenses...")
+        logger.info("Could not return %s %s and %s %s licenses...", dataset_lic, dataset_name, floating_lic, floating_name)
         raise e
 
 def print_final_log(logger, execution_data, idl_license_dict):
     """Print final log message."""
     
     # Organize file data into a string
-    final_log_message = f"final_log: {execution_data}"
-    for key,value in idl_license_dict.items():
-        final_log_message += f" - {key}: {value}"
+    license_data = " - ".join(f"{key}: {value}" for key, value in idl_license_dict.items())
     
-    # Print final log message and remove temp log file
-    logger.info(final_log_message)
+    # Print final log message
+    logger.info("final_log: %s - %s", execution_data, license_data)